@@ -6,20 +6,59 @@
 """
 
 import os
+import re
+import sys
+import csv
+import gzip
+import hmac
+import json
+import io
+import queue
+import itertools
+import random
+import signal
+import hashlib
+import time
 import logging
-from datetime import datetime
-
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+import asyncio
+import sqlite3
+import contextvars
+import tempfile
+import zipfile
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import httpx
+from telegram import (
+    Update,
+    ReplyKeyboardMarkup,
+    ReplyKeyboardRemove,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+)
 from telegram.ext import (
     Application,
+    CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
     ContextTypes,
+    TypeHandler,
     filters,
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.helpers import escape_markdown
+from telegram.request import BaseRequest, HTTPXRequest
 from openai import OpenAI
 
+try:
+    from openpyxl import Workbook
+except ImportError:  # XLSX-выгрузка необязательна
+    Workbook = None
+
 # ==================== ЛОГИРОВАНИЕ ====================
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -31,6 +70,10 @@ logger = logging.getLogger(__name__)
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+ADMINS_FILE = "admins.txt"
+# JSON со списком ботов (регионов) для запуска в одном процессе
+BOTS_CONFIG = os.getenv("BOTS_CONFIG")
+
 ADMIN_IDS = [
     # 123456789,
     # 987654321,
@@ -63,25 +106,25 @@ except Exception as e:
 # ==================== АДМИНЫ ====================
 
 
-def load_admins():
+def load_admins(path: str = ADMINS_FILE):
     """Загрузка списка администраторов из файла"""
     try:
-        with open("admins.txt", "r") as f:
+        with open(path, "r") as f:
             admins = [int(line.strip()) for line in f if line.strip()]
-            logger.info(f"📋 Загружено {len(admins)} администраторов из файла")
+            logger.info(f"📋 Загружено {len(admins)} администраторов из файла {path}")
             return admins
     except FileNotFoundError:
-        logger.info("📋 Файл admins.txt не найден, используются администраторы из кода")
+        logger.info(f"📋 Файл {path} не найден, используются администраторы из кода")
         return ADMIN_IDS.copy()
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки администраторов: {e}")
         return ADMIN_IDS.copy()
 
 
-def save_admins(admins):
+def save_admins(admins, path: str = ADMINS_FILE):
     """Сохранение списка администраторов в файл"""
     try:
-        with open("admins.txt", "w") as f:
+        with open(path, "w") as f:
             for admin_id in admins:
                 f.write(f"{admin_id}\n")
         logger.info(f"💾 Сохранено {len(admins)} администраторов в файл")
@@ -91,20 +134,44 @@ def save_admins(admins):
         return False
 
 
-def is_admin(user_id: int) -> bool:
+def is_admin(user_id: int, path: str = ADMINS_FILE) -> bool:
     """Проверка является ли пользователь администратором"""
-    admins = load_admins()
+    admins = load_admins(path)
     return user_id in admins
 
 
-async def send_to_admins(context: ContextTypes.DEFAULT_TYPE, message: str):
-    """Отправка сообщения всем администраторам"""
-    admins = load_admins()
+def admins_file(context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Файл администраторов бота, обрабатывающего обновление"""
+    return context.bot_data["config"]["admins_file"]
+
+
+async def send_to_admins(
+    context: ContextTypes.DEFAULT_TYPE, message: str, application_id: int | None = None
+):
+    """Постановка сообщения в очередь на отправку всем администраторам"""
+    admins = load_admins(admins_file(context))
 
     if not admins:
         logger.warning("⚠️ Нет администраторов для отправки заявки!")
         return
 
+    try:
+        await asyncio.to_thread(
+            context.bot_data["store"].enqueue_deliveries, application_id, message, admins
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка постановки заявки в очередь: {e}")
+        await send_to_admins_now(context, message, admins)
+        return
+
+    context.bot_data["outbox_wakeup"].set()
+    logger.info(f"📨 Заявка поставлена в очередь для {len(admins)} администраторов")
+
+
+async def send_to_admins_now(
+    context: ContextTypes.DEFAULT_TYPE, message: str, admins: list[int]
+):
+    """Прямая отправка без очереди — если хранилище недоступно"""
     success_count = 0
     for admin_id in admins:
         try:
@@ -123,11 +190,532 @@ async def send_to_admins(context: ContextTypes.DEFAULT_TYPE, message: str):
     )
 
 
+# ==================== ХРАНИЛИЩЕ ЗАЯВОК ====================
+
+APPLICATIONS_DB = os.getenv("APPLICATIONS_DB", "applications.db")
+FIND_PAGE_SIZE = 5
+FIND_USAGE = (
+    "🔎 Поиск заявок:\n"
+    "/find Ленина — по адресу и описанию\n"
+    "/find 4567 — по фрагменту телефона\n"
+    "/find id:123456789 — по Telegram ID\n"
+    "/find с:01.09.2024 по:30.09.2024 — за период\n"
+    "Условия можно сочетать, страница — стр:2"
+)
+
+# Типичные окончания русских слов: отбрасываем их перед префиксным поиском,
+# чтобы «Ленина», «Ленину» и «Ленинский» находились одним запросом
+RU_ENDINGS = sorted(
+    [
+        "ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими",
+        "ая", "яя", "ое", "ее", "ой", "ей", "ий", "ый", "ом", "ем",
+        "ах", "ях", "ов", "ев", "ую", "юю",
+        "а", "я", "ы", "и", "у", "ю", "е", "о",
+    ],
+    key=len,
+    reverse=True,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS applications (
+    id INTEGER PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    user_id INTEGER,
+    username TEXT,
+    first_name TEXT,
+    location TEXT,
+    participants TEXT,
+    damage TEXT,
+    injuries TEXT,
+    contact TEXT,
+    contact_digits TEXT,
+    contact_digits_rev TEXT,
+    photos_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_applications_created_at ON applications(created_at);
+CREATE INDEX IF NOT EXISTS idx_applications_user_id ON applications(user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_applications_contact ON applications(contact_digits);
+CREATE INDEX IF NOT EXISTS idx_applications_contact_rev ON applications(contact_digits_rev);
+
+CREATE TABLE IF NOT EXISTS notifications (
+    application_id INTEGER NOT NULL,
+    admin_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    PRIMARY KEY (application_id, admin_id)
+);
+
+CREATE TABLE IF NOT EXISTS deliveries (
+    id INTEGER PRIMARY KEY,
+    application_id INTEGER,
+    admin_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_deliveries_due ON deliveries(status, next_attempt_at);
+
+"""
+
+FTS_COLUMNS = ("location", "participants", "damage", "injuries")
+# Версия полнотекстового индекса (PRAGMA user_version): при изменении
+# триггеров индекс пересоздаётся и заполняется заново
+FTS_VERSION = 1
+
+
+def fts_values(prefix: str) -> str:
+    """Значения колонок для индекса: unicode61 не сводит «ё» к «е», делаем это сами"""
+    return ", ".join(
+        f"replace(replace({prefix}{column}, 'ё', 'е'), 'Ё', 'Е')" for column in FTS_COLUMNS
+    )
+
+
+FTS_SCHEMA = f"""
+DROP TRIGGER IF EXISTS applications_ai;
+DROP TRIGGER IF EXISTS applications_ad;
+DROP TRIGGER IF EXISTS applications_au;
+DROP TABLE IF EXISTS applications_fts;
+
+CREATE VIRTUAL TABLE applications_fts USING fts5(
+    {", ".join(FTS_COLUMNS)},
+    content='applications',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER applications_ai AFTER INSERT ON applications BEGIN
+    INSERT INTO applications_fts(rowid, {", ".join(FTS_COLUMNS)})
+    VALUES (new.id, {fts_values("new.")});
+END;
+CREATE TRIGGER applications_ad AFTER DELETE ON applications BEGIN
+    INSERT INTO applications_fts(applications_fts, rowid, {", ".join(FTS_COLUMNS)})
+    VALUES ('delete', old.id, {fts_values("old.")});
+END;
+CREATE TRIGGER applications_au AFTER UPDATE OF {", ".join(FTS_COLUMNS)} ON applications BEGIN
+    INSERT INTO applications_fts(applications_fts, rowid, {", ".join(FTS_COLUMNS)})
+    VALUES ('delete', old.id, {fts_values("old.")});
+    INSERT INTO applications_fts(rowid, {", ".join(FTS_COLUMNS)})
+    VALUES (new.id, {fts_values("new.")});
+END;
+
+INSERT INTO applications_fts(rowid, {", ".join(FTS_COLUMNS)})
+SELECT id, {fts_values("")} FROM applications;
+PRAGMA user_version = {FTS_VERSION};
+"""
+
+# Колонки, добавленные после первой версии схемы: докатываются на старые базы
+APPLICATION_COLUMNS = (
+    ("status", "TEXT NOT NULL DEFAULT 'new'"),
+    ("notification_text", "TEXT"),
+    ("sent_at", "TEXT"),
+    ("claimed_by", "INTEGER"),
+    ("claimed_by_name", "TEXT"),
+    ("claimed_at", "TEXT"),
+    ("closed_at", "TEXT"),
+)
+
+# Статусы доставки уведомлений администраторам
+DELIVERY_PENDING = "pending"
+DELIVERY_SENT = "sent"
+DELIVERY_DEAD = "dead"
+
+# Статусы заявки
+STATUS_NEW = "new"
+STATUS_CLAIMED = "claimed"
+STATUS_DONE = "done"
+STATUS_REJECTED = "rejected"
+
+
+def normalize_phone(phone: str | None) -> str:
+    """Приведение телефона к виду 7XXXXXXXXXX (только цифры)"""
+    digits = re.sub(r"\D", "", phone or "")
+    if len(digits) == 11 and digits.startswith("8"):
+        digits = "7" + digits[1:]
+    elif len(digits) == 10:
+        digits = "7" + digits
+    return digits
+
+
+def fts_query(text: str) -> str:
+    """Преобразование пользовательского текста в префиксный запрос FTS5"""
+    terms = []
+    for word in re.findall(r"\w+", text.lower()):
+        word = word.replace("ё", "е")
+        if len(word) >= 5:
+            for ending in RU_ENDINGS:
+                if word.endswith(ending) and len(word) - len(ending) >= 4:
+                    word = word[: -len(ending)]
+                    break
+        terms.append(f'"{word}"*')
+    return " ".join(terms)
+
+
+class ApplicationStore:
+    """Хранилище отправленных заявок (SQLite + полнотекстовый индекс FTS5)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = self.connect()
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+            self._migrate()
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < FTS_VERSION:
+            with self._lock:
+                self._conn.executescript("BEGIN;" + FTS_SCHEMA + "COMMIT;")
+            logger.info("🗄 Полнотекстовый индекс заявок перестроен")
+        logger.info(f"🗄 Хранилище заявок: {path}")
+
+    def connect(self) -> sqlite3.Connection:
+        """Новое соединение с базой (для фоновых потоков — своё)"""
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _migrate(self) -> None:
+        """Добавление недостающих колонок в таблицу заявок"""
+        existing = {
+            row["name"] for row in self._conn.execute("PRAGMA table_info(applications)")
+        }
+        for column, ddl in APPLICATION_COLUMNS:
+            if column not in existing:
+                self._conn.execute(f"ALTER TABLE applications ADD COLUMN {column} {ddl}")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_applications_status"
+            " ON applications(status, created_at)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_applications_sent_at ON applications(sent_at)"
+        )
+
+    def save(self, app: dict, user_info: dict) -> int:
+        """Сохранение заявки, возвращает её номер"""
+        contact_digits = normalize_phone(app.get("contact"))
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                """
+                INSERT INTO applications (
+                    created_at, user_id, username, first_name,
+                    location, participants, damage, injuries,
+                    contact, contact_digits, contact_digits_rev, photos_count
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    app["timestamp"],
+                    user_info.get("user_id"),
+                    user_info.get("username"),
+                    user_info.get("first_name"),
+                    app.get("location"),
+                    app.get("participants"),
+                    app.get("damage"),
+                    app.get("injuries"),
+                    app.get("contact"),
+                    contact_digits,
+                    contact_digits[::-1],
+                    app.get("photos_count", 0),
+                ),
+            )
+        return cursor.lastrowid
+
+    def get(self, application_id: int) -> sqlite3.Row | None:
+        """Заявка по номеру"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT * FROM applications WHERE id = ?", (application_id,)
+            ).fetchone()
+
+    def enqueue_deliveries(
+        self, application_id: int | None, text: str, admin_ids: list[int]
+    ) -> None:
+        """Одной транзакцией ставим уведомление в очередь для каждого администратора"""
+        now = datetime.now()
+        with self._lock, self._conn:
+            if application_id:
+                self._conn.execute(
+                    "UPDATE applications SET notification_text = ?, sent_at = ? WHERE id = ?",
+                    (text, now.isoformat(), application_id),
+                )
+            self._conn.executemany(
+                "INSERT INTO deliveries (application_id, admin_id, text, status,"
+                " next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (application_id, admin_id, text, DELIVERY_PENDING, now.timestamp(), now.isoformat())
+                    for admin_id in admin_ids
+                ],
+            )
+
+    def due_deliveries(self, limit: int) -> list[sqlite3.Row]:
+        """Доставки, время которых подошло (не больше limit за раз)"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT * FROM deliveries WHERE status = ? AND next_attempt_at <= ?"
+                " ORDER BY next_attempt_at LIMIT ?",
+                (DELIVERY_PENDING, time.time(), limit),
+            ).fetchall()
+
+    def next_delivery_at(self) -> float | None:
+        """Время ближайшей запланированной доставки"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(next_attempt_at) FROM deliveries WHERE status = ?",
+                (DELIVERY_PENDING,),
+            ).fetchone()
+        return row[0]
+
+    def mark_delivered(self, delivery: sqlite3.Row, message_id: int) -> None:
+        """Доставка выполнена: запоминаем сообщение для последующих правок"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE deliveries SET status = ?, attempts = attempts + 1 WHERE id = ?",
+                (DELIVERY_SENT, delivery["id"]),
+            )
+            if delivery["application_id"]:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO notifications (application_id, admin_id, message_id)"
+                    " VALUES (?, ?, ?)",
+                    (delivery["application_id"], delivery["admin_id"], message_id),
+                )
+
+    def reschedule_delivery(
+        self, delivery_id: int, attempts: int, next_attempt_at: float, error: str
+    ) -> None:
+        """Повторная попытка доставки позже"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE deliveries SET attempts = ?, next_attempt_at = ?, last_error = ?"
+                " WHERE id = ?",
+                (attempts, next_attempt_at, error, delivery_id),
+            )
+
+    def mark_dead(self, delivery_id: int, attempts: int, error: str) -> None:
+        """Доставка невозможна — больше не пытаемся"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE deliveries SET status = ?, attempts = ?, last_error = ? WHERE id = ?",
+                (DELIVERY_DEAD, attempts, error, delivery_id),
+            )
+
+    def requeue_dead(self) -> int:
+        """Вернуть недоставленные уведомления в очередь (сутки на доставку отсчитываются заново)"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE deliveries SET status = ?, next_attempt_at = ?, created_at = ?"
+                " WHERE status = ?",
+                (DELIVERY_PENDING, time.time(), datetime.now().isoformat(), DELIVERY_DEAD),
+            )
+        return cursor.rowcount
+
+    def outbox_stats(self) -> dict:
+        """Количество доставок по статусам"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM deliveries GROUP BY status"
+            ).fetchall()
+        return {status: count for status, count in rows}
+
+    def notifications(self, application_id: int) -> list[sqlite3.Row]:
+        """Все копии уведомления о заявке"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT admin_id, message_id FROM notifications WHERE application_id = ?",
+                (application_id,),
+            ).fetchall()
+
+    def claim(self, application_id: int, admin_id: int, admin_name: str) -> bool:
+        """Атомарно закрепить новую заявку за администратором"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE applications SET status = ?, claimed_by = ?, claimed_by_name = ?,"
+                " claimed_at = ? WHERE id = ? AND status = ?",
+                (
+                    STATUS_CLAIMED,
+                    admin_id,
+                    admin_name,
+                    datetime.now().isoformat(),
+                    application_id,
+                    STATUS_NEW,
+                ),
+            )
+        return cursor.rowcount == 1
+
+    def close(self, application_id: int, admin_id: int, status: str) -> bool:
+        """Закрыть заявку (выполнена/отклонена) — только тем, кто её взял"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE applications SET status = ?, closed_at = ?"
+                " WHERE id = ? AND status = ? AND claimed_by = ?",
+                (
+                    status,
+                    datetime.now().isoformat(),
+                    application_id,
+                    STATUS_CLAIMED,
+                    admin_id,
+                ),
+            )
+        return cursor.rowcount == 1
+
+    def find(
+        self,
+        text: str | None = None,
+        phone: str | None = None,
+        user_id: int | None = None,
+        date_from: str | None = None,
+        date_to: str | None = None,
+        page: int = 1,
+        page_size: int = FIND_PAGE_SIZE,
+    ) -> tuple[list[sqlite3.Row], bool]:
+        """Поиск заявок, возвращает (страница результатов, есть ли ещё)"""
+        sql = "SELECT a.* FROM applications a"
+        where, params = [], []
+
+        if text:
+            sql += " JOIN applications_fts f ON f.rowid = a.id"
+            where.append("applications_fts MATCH ?")
+            params.append(fts_query(text))
+
+        if phone:
+            digits = re.sub(r"\D", "", phone)
+            if len(digits) >= 10:
+                where.append("a.contact_digits = ?")
+                params.append(normalize_phone(digits))
+            else:
+                # Фрагмент ищем как начало номера (с кодом страны и без)
+                # или как его окончание — все три варианта идут по индексам
+                where.append(
+                    "(a.contact_digits GLOB ? OR a.contact_digits GLOB ?"
+                    " OR a.contact_digits_rev GLOB ?)"
+                )
+                params.extend([f"{digits}*", f"7{digits}*", f"{digits[::-1]}*"])
+
+        if user_id is not None:
+            where.append("a.user_id = ?")
+            params.append(user_id)
+        if date_from:
+            where.append("a.created_at >= ?")
+            params.append(date_from)
+        if date_to:
+            where.append("a.created_at < ?")
+            params.append(date_to)
+
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY a.id DESC LIMIT ? OFFSET ?"
+        params.extend([page_size + 1, (page - 1) * page_size])
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return rows[:page_size], len(rows) > page_size
+
+    def iter_period(self, date_from: str, date_to: str, chunk_size: int = 1000):
+        """Построчный обход заявок, отправленных за период (своё соединение, порциями)"""
+        conn = self.connect()
+        try:
+            cursor = conn.execute(
+                "SELECT * FROM applications WHERE sent_at >= ? AND sent_at < ?"
+                " ORDER BY sent_at, id",
+                (date_from, date_to),
+            )
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+
 # ==================== AI ====================
 
 
+# Инструкции держим байт-в-байт неизменными: провайдер кэширует общий
+# префикс запроса, а текущие данные заявки уходят отдельным хвостовым сообщением.
+SYSTEM_PROMPT = """Ты - помощник аварийного комиссара. Помогаешь оформить заявку после ДТП.
+
+Твоя задача:
+1. Собрать информацию: место ДТП, участники, повреждения, пострадавшие, контакт
+2. Быть вежливым и кратким
+3. Задавать по одному вопросу за раз
+
+Последнее системное сообщение перед вопросом пользователя содержит текущие данные заявки.
+Если поле не заполнено (—), спроси о нём. Отвечай кратко на русском языке."""
+
+APPLICATION_STATE_FIELDS = (
+    ("location", "место"),
+    ("participants", "участники"),
+    ("damage", "повреждения"),
+    ("injuries", "пострадавшие"),
+    ("contact", "контакт"),
+)
+
+# Накопительная статистика расхода токенов по всем вызовам AI
+AI_USAGE = {
+    "calls": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+    "cached_tokens": 0,
+    "latency_total": 0.0,
+}
+# get_ai_response выполняется в потоках asyncio.to_thread сразу для всех ботов
+AI_USAGE_LOCK = threading.Lock()
+
+
+def format_application_state(application_data: dict) -> str:
+    """Компактное представление текущих данных заявки для AI"""
+    parts = [
+        f"{label}={application_data.get(key) or '—'}"
+        for key, label in APPLICATION_STATE_FIELDS
+    ]
+    return "Данные заявки: " + "; ".join(parts)
+
+
+def build_ai_messages(
+    user_message: str,
+    conversation_history: list,
+    application_data: dict,
+    system_prompt: str = SYSTEM_PROMPT,
+) -> list:
+    """Сборка запроса: стабильный префикс, история, состояние заявки, вопрос"""
+    messages = [{"role": "system", "content": system_prompt}]
+    messages.extend(conversation_history[-10:])
+    messages.append(
+        {"role": "system", "content": format_application_state(application_data)}
+    )
+    messages.append({"role": "user", "content": user_message})
+    return messages
+
+
+def record_ai_usage(usage, latency: float) -> None:
+    """Учёт токенов и задержки одного вызова AI"""
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", 0) or 0
+
+    with AI_USAGE_LOCK:
+        AI_USAGE["calls"] += 1
+        AI_USAGE["latency_total"] += latency
+        AI_USAGE["prompt_tokens"] += prompt_tokens
+        AI_USAGE["completion_tokens"] += completion_tokens
+        AI_USAGE["cached_tokens"] += cached_tokens
+
+    if usage is None:
+        logger.info(f"📊 AI: {latency:.2f} с, данные о токенах отсутствуют")
+        return
+    logger.info(
+        f"📊 AI: {latency:.2f} с, prompt={prompt_tokens} "
+        f"(из кэша {cached_tokens}), completion={completion_tokens}"
+    )
+
+
 def get_ai_response(
-    user_message: str, conversation_history: list, application_data: dict
+    user_message: str,
+    conversation_history: list,
+    application_data: dict,
+    system_prompt: str = SYSTEM_PROMPT,
 ) -> str:
     """Получить ответ от AI-агента OpenAI"""
 
@@ -138,35 +726,23 @@ def get_ai_response(
         )
 
     try:
-        system_prompt = f"""Ты - помощник аварийного комиссара. Помогаешь оформить заявку после ДТП.
-
-Твоя задача:
-1. Собрать информацию: место ДТП, участники, повреждения, пострадавшие, контакт
-2. Быть вежливым и кратким
-3. Задавать по одному вопросу за раз
-
-Текущие данные заявки:
-- Место: {application_data.get('location', 'не указано')}
-- Участники: {application_data.get('participants', 'не указано')}
-- Повреждения: {application_data.get('damage', 'не указано')}
-- Пострадавшие: {application_data.get('injuries', 'не указано')}
-- Контакт: {application_data.get('contact', 'не указано')}
-
-Если поле не заполнено, спроси о нём. Отвечай кратко на русском языке."""
-
-        messages = [{"role": "system", "content": system_prompt}]
-        messages.extend(conversation_history[-10:])
-        messages.append({"role": "user", "content": user_message})
+        messages = build_ai_messages(
+            user_message, conversation_history, application_data, system_prompt
+        )
 
+        started = time.monotonic()
         response = openai_client.chat.completions.create(
             model="gpt-3.5-turbo",
             messages=messages,
             max_tokens=300,
             temperature=0.7,
         )
+        record_ai_usage(response.usage, time.monotonic() - started)
 
         ai_message = response.choices[0].message.content
         logger.info(f"✅ Получен ответ от AI: {ai_message[:50]}...")
+        if traffic_recorder:
+            traffic_recorder.record_ai(current_bot_name.get(), current_chat_id.get(), ai_message)
         return ai_message
 
     except Exception as e:
@@ -240,8 +816,6 @@ def extract_info_from_message(message: str, application: dict) -> dict:
 
     # Телефон
     if not application.get("contact"):
-        import re
-
         phone_patterns = [
             r"\+7[\s-]?\d{3}[\s-]?\d{3}[\s-]?\d{2}[\s-]?\d{2}",
             r"8[\s-]?\d{3}[\s-]?\d{3}[\s-]?\d{2}[\s-]?\d{2}",
@@ -270,8 +844,10 @@ Telegram ID: `{user_info.get('user_id', 'н/д')}`
 
 """
 
+    number = f" №{app['id']}" if app.get("id") else ""
+
     return f"""
-🚨 *НОВАЯ ЗАЯВКА НА АВАРИЙНОГО КОМИССАРА*
+🚨 *НОВАЯ ЗАЯВКА НА АВАРИЙНОГО КОМИССАРА*{number}
 ━━━━━━━━━━━━━━━━━━━━━
 {user_section}
 🕐 *Дата и время:*
@@ -305,7 +881,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.effective_user
     logger.info(f"👤 Пользователь {user.first_name} ({user.id}) начал работу")
 
-    if is_admin(user.id):
+    if is_admin(user.id, admins_file(context)):
         keyboard = [
             ["🤖 Общаться с AI-помощником"],
             ["📋 Заполнить по шагам"],
@@ -347,7 +923,7 @@ async def choose_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     choice = update.message.text
     logger.info(f"📌 Выбран режим: {choice}")
 
-    if "⚙️" in choice and is_admin(update.effective_user.id):
+    if "⚙️" in choice and is_admin(update.effective_user.id, admins_file(context)):
         return await admin_menu(update, context)
 
     if "🤖" in choice or "AI" in choice.upper():
@@ -372,14 +948,14 @@ async def choose_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
 async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Меню управления администраторами"""
-    if not is_admin(update.effective_user.id):
+    if not is_admin(update.effective_user.id, admins_file(context)):
         await update.message.reply_text(
             "❌ У вас нет доступа к этой функции.",
             reply_markup=ReplyKeyboardRemove(),
         )
         return ConversationHandler.END
 
-    admins = load_admins()
+    admins = load_admins(admins_file(context))
     admin_list = (
         "\n".join([f"• {admin_id}" for admin_id in admins])
         if admins
@@ -423,7 +999,7 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ADMIN_ADD
 
     elif "➖" in choice:
-        admins = load_admins()
+        admins = load_admins(admins_file(context))
         if not admins:
             await update.message.reply_text(
                 "❌ Нет администраторов для удаления.",
@@ -442,7 +1018,7 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ADMIN_REMOVE
 
     elif "📋" in choice:
-        admins = load_admins()
+        admins = load_admins(admins_file(context))
         admin_list = (
             "\n".join([f"• `{admin_id}`" for admin_id in admins])
             if admins
@@ -464,7 +1040,7 @@ async def admin_add_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Добавление администратора"""
     try:
         new_admin_id = int(update.message.text.strip())
-        admins = load_admins()
+        admins = load_admins(admins_file(context))
 
         if new_admin_id in admins:
             await update.message.reply_text(
@@ -472,7 +1048,7 @@ async def admin_add_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
         else:
             admins.append(new_admin_id)
-            if save_admins(admins):
+            if save_admins(admins, admins_file(context)):
                 await update.message.reply_text(
                     f"✅ Администратор {new_admin_id} успешно добавлен!"
                 )
@@ -494,7 +1070,7 @@ async def admin_remove_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     """Удаление администратора"""
     try:
         remove_admin_id = int(update.message.text.strip())
-        admins = load_admins()
+        admins = load_admins(admins_file(context))
 
         if remove_admin_id not in admins:
             await update.message.reply_text(
@@ -506,7 +1082,7 @@ async def admin_remove_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             )
         else:
             admins.remove(remove_admin_id)
-            if save_admins(admins):
+            if save_admins(admins, admins_file(context)):
                 await update.message.reply_text(
                     f"✅ Администратор {remove_admin_id} успешно удалён!"
                 )
@@ -524,12 +1100,543 @@ async def admin_remove_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         return ADMIN_REMOVE
 
 
+# ==================== ОБРАБОТКА ЗАЯВОК ====================
+
+
+def application_keyboard(application_id: int, status: str) -> InlineKeyboardMarkup | None:
+    """Кнопки под уведомлением о заявке в зависимости от статуса"""
+    if status == STATUS_NEW:
+        buttons = [
+            InlineKeyboardButton("🙋 Беру", callback_data=f"app:claim:{application_id}")
+        ]
+    elif status == STATUS_CLAIMED:
+        buttons = [
+            InlineKeyboardButton("✅ Выполнена", callback_data=f"app:done:{application_id}"),
+            InlineKeyboardButton("🚫 Отклонить", callback_data=f"app:reject:{application_id}"),
+        ]
+    else:
+        return None
+    return InlineKeyboardMarkup([buttons])
+
+
+def minutes_between(start: str | None, end: str | None) -> int | None:
+    """Минуты между двумя ISO-отметками времени"""
+    if not start or not end:
+        return None
+    delta = datetime.fromisoformat(end) - datetime.fromisoformat(start)
+    return int(delta.total_seconds() // 60)
+
+
+def application_status_line(row: sqlite3.Row) -> str:
+    """Строка статуса, дописываемая к уведомлению"""
+    name = escape_markdown(row["claimed_by_name"] or str(row["claimed_by"]))
+    if row["status"] == STATUS_CLAIMED:
+        minutes = minutes_between(row["sent_at"], row["claimed_at"])
+        suffix = f" (через {minutes} мин)" if minutes is not None else ""
+        return f"🔒 *Взял:* {name}{suffix}"
+    if row["status"] == STATUS_DONE:
+        return f"✅ *Выполнена:* {name}"
+    if row["status"] == STATUS_REJECTED:
+        return f"🚫 *Отклонена:* {name}"
+    return ""
+
+
+def notification_view(row: sqlite3.Row, admin_id: int) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Текст и кнопки уведомления о заявке для конкретного администратора"""
+    if row["status"] == STATUS_NEW:
+        return row["notification_text"], application_keyboard(row["id"], STATUS_NEW)
+
+    text = row["notification_text"] + "\n" + application_status_line(row)
+    # Кнопки «выполнена/отклонить» видит только тот, кто взял заявку
+    reply_markup = None
+    if admin_id == row["claimed_by"]:
+        reply_markup = application_keyboard(row["id"], row["status"])
+    return text, reply_markup
+
+
+async def refresh_notifications(context: ContextTypes.DEFAULT_TYPE, application_id: int) -> None:
+    """Обновление всех копий уведомления о заявке у администраторов"""
+    store = context.bot_data["store"]
+    row = await asyncio.to_thread(store.get, application_id)
+    copies = await asyncio.to_thread(store.notifications, application_id)
+    if row is None or not row["notification_text"]:
+        return
+
+    async def edit(copy):
+        text, reply_markup = notification_view(row, copy["admin_id"])
+        try:
+            await context.bot.edit_message_text(
+                chat_id=copy["admin_id"],
+                message_id=copy["message_id"],
+                text=text,
+                parse_mode="Markdown",
+                reply_markup=reply_markup,
+            )
+        except Exception as e:
+            logger.error(f"❌ Не удалось обновить заявку у {copy['admin_id']}: {e}")
+
+    await asyncio.gather(*(edit(copy) for copy in copies))
+
+
+async def application_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Нажатия кнопок «беру / выполнена / отклонить» под заявкой"""
+    query = update.callback_query
+    user = update.effective_user
+
+    if not is_admin(user.id, admins_file(context)):
+        await query.answer("❌ У вас нет доступа к этой функции.", show_alert=True)
+        return
+
+    try:
+        _, action, raw_id = query.data.split(":")
+        application_id = int(raw_id)
+    except ValueError:
+        await query.answer()
+        return
+
+    store = context.bot_data["store"]
+    admin_name = f"@{user.username}" if user.username else user.first_name
+
+    if action == "claim":
+        ok = await asyncio.to_thread(store.claim, application_id, user.id, admin_name)
+    elif action in ("done", "reject"):
+        status = STATUS_DONE if action == "done" else STATUS_REJECTED
+        ok = await asyncio.to_thread(store.close, application_id, user.id, status)
+    else:
+        await query.answer()
+        return
+
+    row = await asyncio.to_thread(store.get, application_id)
+    if not ok:
+        taken_by = row["claimed_by_name"] if row else None
+        await query.answer(
+            f"⚠️ Заявка уже у {taken_by}" if taken_by else "⚠️ Заявка уже обработана",
+            show_alert=True,
+        )
+        return
+
+    if action == "claim":
+        logger.info(
+            f"🙋 Заявку №{application_id} взял {admin_name} ({user.id}) через "
+            f"{minutes_between(row['sent_at'], row['claimed_at'])} мин"
+        )
+        await query.answer("✅ Заявка закреплена за вами")
+    else:
+        logger.info(f"📌 Заявка №{application_id}: {row['status']} ({admin_name})")
+        await query.answer("✅ Статус обновлён")
+
+    await refresh_notifications(context, application_id)
+
+
+# ==================== ОЧЕРЕДЬ УВЕДОМЛЕНИЙ ====================
+
+OUTBOX_BATCH_SIZE = 20
+OUTBOX_POLL_INTERVAL = 30.0
+# Сетевые сбои не считаются окончательными: повторяем, пока уведомлению
+# меньше суток (с паузами до OUTBOX_BACKOFF_MAX)
+OUTBOX_MAX_AGE = 24 * 3600.0
+OUTBOX_BACKOFF_BASE = 5.0
+OUTBOX_BACKOFF_MAX = 600.0
+
+
+def outbox_backoff(attempts: int) -> float:
+    """Экспоненциальная задержка перед повторной попыткой (с разбросом)"""
+    delay = min(OUTBOX_BACKOFF_BASE * 2 ** min(attempts - 1, 16), OUTBOX_BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+async def deliver(application: Application, delivery: sqlite3.Row) -> float | None:
+    """Одна попытка доставки. Возвращает паузу, если Telegram просит подождать"""
+    store = application.bot_data["store"]
+    text, reply_markup = delivery["text"], None
+    if delivery["application_id"]:
+        # Заявку могли взять, пока уведомление ждало в очереди
+        row = await asyncio.to_thread(store.get, delivery["application_id"])
+        if row is not None and row["notification_text"]:
+            text, reply_markup = notification_view(row, delivery["admin_id"])
+
+    attempts = delivery["attempts"] + 1
+    try:
+        sent = await application.bot.send_message(
+            chat_id=delivery["admin_id"],
+            text=text,
+            parse_mode="Markdown",
+            reply_markup=reply_markup,
+        )
+    except RetryAfter as e:
+        retry_after = float(e.retry_after)
+        await asyncio.to_thread(
+            store.reschedule_delivery,
+            delivery["id"],
+            delivery["attempts"],
+            time.time() + retry_after,
+            str(e),
+        )
+        logger.warning(f"⏳ Telegram просит подождать {retry_after:.0f} с")
+        return retry_after
+    except (Forbidden, BadRequest) as e:
+        # Бот заблокирован или чат не существует — повтор не поможет
+        await asyncio.to_thread(store.mark_dead, delivery["id"], attempts, str(e))
+        logger.error(f"☠️ Уведомление администратору {delivery['admin_id']} не доставлено: {e}")
+        return None
+    except Exception as e:
+        age = time.time() - datetime.fromisoformat(delivery["created_at"]).timestamp()
+        if age >= OUTBOX_MAX_AGE:
+            await asyncio.to_thread(store.mark_dead, delivery["id"], attempts, str(e))
+            logger.error(
+                f"☠️ Уведомление администратору {delivery['admin_id']} не доставлено "
+                f"за {age / 3600:.0f} ч ({attempts} попыток): {e}"
+            )
+        else:
+            delay = outbox_backoff(attempts)
+            await asyncio.to_thread(
+                store.reschedule_delivery,
+                delivery["id"],
+                attempts,
+                time.time() + delay,
+                str(e),
+            )
+            logger.warning(
+                f"🔁 Ошибка отправки администратору {delivery['admin_id']} "
+                f"(попытка {attempts}), повтор через {delay:.0f} с: {e}"
+            )
+        return None
+
+    await asyncio.to_thread(store.mark_delivered, delivery, sent.message_id)
+    logger.info(f"✅ Заявка отправлена администратору {delivery['admin_id']}")
+    return None
+
+
+async def outbox_worker(application: Application) -> None:
+    """Фоновая отправка уведомлений из очереди в базе"""
+    store = application.bot_data["store"]
+    wakeup = application.bot_data["outbox_wakeup"]
+    logger.info("📬 Очередь уведомлений запущена")
+
+    while True:
+        try:
+            # Сбрасываем до выборки: сигнал о новой заявке, пришедший во время
+            # запросов к базе, не должен потеряться
+            wakeup.clear()
+            pause = None
+            batch = await asyncio.to_thread(store.due_deliveries, OUTBOX_BATCH_SIZE)
+            for delivery in batch:
+                pause = await deliver(application, delivery)
+                if pause:
+                    break
+
+            if pause:
+                await asyncio.sleep(pause)
+                continue
+            if len(batch) == OUTBOX_BATCH_SIZE:
+                continue
+
+            next_at = await asyncio.to_thread(store.next_delivery_at)
+            timeout = OUTBOX_POLL_INTERVAL
+            if next_at is not None:
+                timeout = min(max(next_at - time.time(), 0), OUTBOX_POLL_INTERVAL)
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка очереди уведомлений: {e}")
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+
+async def retry_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Повторная отправка недоставленных уведомлений (только для администраторов)"""
+    if not is_admin(update.effective_user.id, admins_file(context)):
+        await update.message.reply_text("❌ У вас нет доступа к этой функции.")
+        return
+
+    count = await asyncio.to_thread(context.bot_data["store"].requeue_dead)
+    logger.info(f"🔁 Возвращено в очередь уведомлений: {count}")
+    if count:
+        context.bot_data["outbox_wakeup"].set()
+        await update.message.reply_text(f"🔁 Уведомлений возвращено в очередь: {count}")
+    else:
+        await update.message.reply_text("✅ Недоставленных уведомлений нет.")
+
+
+async def start_outbox(application: Application) -> None:
+    """Запуск фоновой отправки после инициализации бота"""
+    application.bot_data["outbox_task"] = asyncio.create_task(outbox_worker(application))
+
+
+async def stop_outbox(application: Application) -> None:
+    """Остановка фоновой отправки"""
+    task = application.bot_data.pop("outbox_task", None)
+    if task:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+# ==================== ПОИСК ЗАЯВОК ====================
+
+
+def parse_date(value: str) -> datetime:
+    """Дата в формате ДД.ММ.ГГГГ или ГГГГ-ММ-ДД"""
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"Неверная дата: {value}")
+
+
+def parse_find_args(args: list[str]) -> dict:
+    """Разбор аргументов /find: тел:, id:, с:, по:, стр: и свободный текст"""
+    query = {"page": 1}
+    words = []
+    for arg in args:
+        key, sep, value = arg.partition(":")
+        key = key.lower()
+        if sep and value:
+            if key in ("тел", "phone"):
+                query["phone"] = value
+                continue
+            if key == "id":
+                query["user_id"] = int(value)
+                continue
+            if key in ("с", "from"):
+                query["date_from"] = parse_date(value).isoformat()
+                continue
+            if key in ("по", "to"):
+                query["date_to"] = (parse_date(value) + timedelta(days=1)).isoformat()
+                continue
+            if key in ("стр", "page"):
+                query["page"] = max(1, int(value))
+                continue
+        words.append(arg)
+
+    text = " ".join(words)
+    # Запрос из одних цифр телефона считаем поиском по номеру
+    if text and re.fullmatch(r"[\d\s()+-]+", text) and len(re.sub(r"\D", "", text)) >= 3:
+        query["phone"] = text
+    elif fts_query(text):
+        query["text"] = text
+    return query
+
+
+def format_search_row(row: sqlite3.Row) -> str:
+    """Краткая строка заявки для результатов поиска"""
+    created = datetime.fromisoformat(row["created_at"]).strftime("%d.%m.%Y %H:%M")
+    user = f"@{row['username']}" if row["username"] else row["first_name"] or "—"
+    return (
+        f"№{row['id']} · {created}\n"
+        f"📍 {row['location'] or 'не указано'}\n"
+        f"📞 {row['contact'] or 'не указано'} · 👤 {user} ({row['user_id']})"
+    )
+
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Поиск по истории заявок (только для администраторов)"""
+    if not is_admin(update.effective_user.id, admins_file(context)):
+        await update.message.reply_text("❌ У вас нет доступа к этой функции.")
+        return
+
+    try:
+        query = parse_find_args(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(f"❌ Неверный запрос: {e}")
+        return
+
+    # Ни одного условия (пустой запрос или одни знаки препинания)
+    if query.keys() <= {"page"}:
+        await update.message.reply_text(FIND_USAGE)
+        return
+
+    started = time.monotonic()
+    try:
+        rows, has_more = await asyncio.to_thread(context.bot_data["store"].find, **query)
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка поиска заявок: {e}")
+        await update.message.reply_text("❌ Ошибка при поиске заявок.")
+        return
+    elapsed_ms = (time.monotonic() - started) * 1000
+
+    if not rows:
+        await update.message.reply_text("🔎 Ничего не найдено.")
+        return
+
+    page = query["page"]
+    footer = f"Страница {page} · {elapsed_ms:.0f} мс"
+    if has_more:
+        footer += f"\nДальше: добавьте к запросу стр:{page + 1}"
+
+    await update.message.reply_text(
+        "🔎 Найденные заявки:\n\n"
+        + "\n\n".join(format_search_row(row) for row in rows)
+        + f"\n\n{footer}"
+    )
+
+
+# ==================== ВЫГРУЗКА ЗАЯВОК ====================
+
+EXPORT_COLUMNS = (
+    ("id", "№"),
+    ("created_at", "Дата и время"),
+    ("sent_at", "Отправлена"),
+    ("user_id", "Telegram ID"),
+    ("username", "Username"),
+    ("first_name", "Имя"),
+    ("location", "Место ДТП"),
+    ("participants", "Участники"),
+    ("damage", "Повреждения"),
+    ("injuries", "Пострадавшие"),
+    ("contact", "Контакт"),
+)
+
+
+def export_rows(rows):
+    """Заявки в виде строк таблицы (генератор)"""
+    for row in rows:
+        yield [row[key] for key, _ in EXPORT_COLUMNS]
+
+
+def write_csv(rows, path: str, name: str) -> int:
+    """Запись строк в CSV (файл name внутри zip-архива), возвращает их количество"""
+    count = 0
+    # При отправке PTB читает файл в память целиком, поэтому CSV сжимаем;
+    # utf-8-sig — чтобы Excel сразу открыл кириллицу
+    with (
+        zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive,
+        archive.open(name, "w") as member,
+        io.TextIOWrapper(member, encoding="utf-8-sig", newline="") as f,
+    ):
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow([title for _, title in EXPORT_COLUMNS])
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_xlsx(rows, path: str, name: str) -> int:
+    """Запись строк в XLSX в потоковом режиме openpyxl (XLSX уже сжат)"""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Заявки")
+    sheet.append([title for _, title in EXPORT_COLUMNS])
+    count = 0
+    for row in rows:
+        sheet.append(row)
+        count += 1
+    workbook.save(path)
+    return count
+
+
+def export_filename(name: str, fmt: str) -> str:
+    """Имя файла выгрузки: CSV отправляется в zip-архиве"""
+    return f"{name}.xlsx" if fmt == "xlsx" else f"{name}.csv.zip"
+
+
+def export_applications(
+    store: ApplicationStore, date_from: str, date_to: str, fmt: str, name: str
+) -> tuple[str, int]:
+    """Выгрузка заявок за период во временный файл, возвращает (путь, количество)"""
+    fd, path = tempfile.mkstemp(prefix="applications_", suffix=f".{fmt}")
+    os.close(fd)
+    writer = write_xlsx if fmt == "xlsx" else write_csv
+    try:
+        count = writer(
+            export_rows(store.iter_period(date_from, date_to)), path, f"{name}.{fmt}"
+        )
+    except Exception:
+        os.remove(path)
+        raise
+    return path, count
+
+
+def parse_export_args(args: list[str]) -> tuple[datetime, datetime, str]:
+    """Разбор аргументов /export: месяц или две даты, затем формат"""
+    fmt = "csv"
+    if args and args[-1].lower() in ("csv", "xlsx"):
+        fmt = args[-1].lower()
+        args = args[:-1]
+
+    if len(args) == 1:
+        start = datetime.strptime(args[0], "%Y-%m")
+        end = (start + timedelta(days=32)).replace(day=1)
+    elif len(args) == 2:
+        start = parse_date(args[0])
+        end = parse_date(args[1]) + timedelta(days=1)
+    else:
+        raise ValueError("укажите месяц (2024-09) или две даты")
+    return start, end, fmt
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Выгрузка заявок за период в CSV/XLSX (только для администраторов)"""
+    if not is_admin(update.effective_user.id, admins_file(context)):
+        await update.message.reply_text("❌ У вас нет доступа к этой функции.")
+        return
+
+    try:
+        start, end, fmt = parse_export_args(context.args or [])
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ Неверный запрос: {e}\n\n"
+            "📤 Выгрузка заявок:\n"
+            "/export 2024-09 — за месяц в CSV (zip)\n"
+            "/export 2024-09 xlsx — за месяц в Excel\n"
+            "/export 01.09.2024 15.09.2024 csv — за период"
+        )
+        return
+
+    if fmt == "xlsx" and Workbook is None:
+        await update.message.reply_text(
+            "❌ Выгрузка в XLSX недоступна: не установлен openpyxl. Используйте csv."
+        )
+        return
+
+    await update.message.reply_text("⏳ Готовлю выгрузку...")
+
+    name = f"applications_{start:%Y%m%d}_{end - timedelta(days=1):%Y%m%d}"
+    started = time.monotonic()
+    try:
+        path, count = await asyncio.to_thread(
+            export_applications,
+            context.bot_data["store"],
+            start.isoformat(),
+            end.isoformat(),
+            fmt,
+            name,
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка выгрузки заявок: {e}")
+        await update.message.reply_text("❌ Ошибка при выгрузке заявок.")
+        return
+
+    period = f"{start:%d.%m.%Y}–{(end - timedelta(days=1)):%d.%m.%Y}"
+    logger.info(
+        f"📤 Выгрузка {fmt}: {count} заявок за {period}, "
+        f"{time.monotonic() - started:.1f} с"
+    )
+
+    try:
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                document=f,
+                filename=export_filename(name, fmt),
+                caption=f"📤 Заявки за {period}: {count}",
+            )
+    finally:
+        os.remove(path)
+
+
 # ==================== РЕЖИМ С КНОПКАМИ ====================
 
 
 async def get_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["application"]["location"] = update.message.text
-    logger.info(f"📍 Место ДТП: {update.message.text}")
+    text = message_text(update, context)
+    context.user_data["application"]["location"] = text
+    logger.info(f"📍 Место ДТП: {text}")
 
     keyboard = [
         ["2 автомобиля", "3 автомобиля"],
@@ -548,8 +1655,9 @@ async def get_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
 
 async def get_participants(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["application"]["participants"] = update.message.text
-    logger.info(f"👥 Участники: {update.message.text}")
+    text = message_text(update, context)
+    context.user_data["application"]["participants"] = text
+    logger.info(f"👥 Участники: {text}")
 
     await update.message.reply_text(
         "✅ Количество участников сохранено.\n\n"
@@ -561,8 +1669,9 @@ async def get_participants(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 
 async def get_damage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["application"]["damage"] = update.message.text
-    logger.info(f"🚗 Повреждения: {update.message.text}")
+    text = message_text(update, context)
+    context.user_data["application"]["damage"] = text
+    logger.info(f"🚗 Повреждения: {text}")
 
     keyboard = [
         ["Нет пострадавших"],
@@ -581,8 +1690,9 @@ async def get_damage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 
 async def get_injuries(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["application"]["injuries"] = update.message.text
-    logger.info(f"🚑 Пострадавшие: {update.message.text}")
+    text = message_text(update, context)
+    context.user_data["application"]["injuries"] = text
+    logger.info(f"🚑 Пострадавшие: {text}")
 
     await update.message.reply_text(
         "✅ Информация сохранена.\n\n"
@@ -594,8 +1704,9 @@ async def get_injuries(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
 
 async def get_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["application"]["contact"] = update.message.text
-    logger.info(f"📞 Контакт: {update.message.text}")
+    text = message_text(update, context)
+    context.user_data["application"]["contact"] = text
+    logger.info(f"📞 Контакт: {text}")
 
     app = context.user_data["application"]
 
@@ -642,7 +1753,7 @@ async def get_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
 
 async def ai_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user_message = update.message.text
+    user_message = message_text(update, context)
     logger.info(f"💬 AI-чат: {user_message}")
 
     if user_message.lower() in ["/finish", "завершить", "закончить", "готово"]:
@@ -651,24 +1762,26 @@ async def ai_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     app = context.user_data["application"]
     updated_fields = extract_info_from_message(user_message, app)
 
-    context.user_data["ai_history"].append(
-        {
-            "role": "user",
-            "content": user_message,
-        }
-    )
-
-    ai_response = get_ai_response(
+    # Синхронный вызов OpenAI уводим из цикла событий: он общий для всех ботов
+    ai_response = await asyncio.to_thread(
+        get_ai_response,
         user_message,
         context.user_data["ai_history"],
         app,
+        context.bot_data["config"]["system_prompt"],
     )
 
-    context.user_data["ai_history"].append(
-        {
-            "role": "assistant",
-            "content": ai_response,
-        }
+    context.user_data["ai_history"].extend(
+        [
+            {
+                "role": "user",
+                "content": user_message,
+            },
+            {
+                "role": "assistant",
+                "content": ai_response,
+            },
+        ]
     )
 
     if updated_fields:
@@ -752,9 +1865,16 @@ async def confirm_application(update: Update, context: ContextTypes.DEFAULT_TYPE
             "user_id": user.id,
         }
 
+        try:
+            app["id"] = await asyncio.to_thread(
+                context.bot_data["store"].save, app, user_info
+            )
+        except Exception as e:
+            logger.error(f"❌ Ошибка сохранения заявки: {e}")
+
         formatted_application = format_application(app, user_info)
 
-        await send_to_admins(context, formatted_application)
+        await send_to_admins(context, formatted_application, app.get("id"))
 
         logger.info("=" * 50)
         logger.info("📨 НОВАЯ ЗАЯВКА ОТПРАВЛЕНА:")
@@ -783,6 +1903,746 @@ async def confirm_application(update: Update, context: ContextTypes.DEFAULT_TYPE
         return ConversationHandler.END
 
 
+# ==================== ЗАПИСЬ ТРАФИКА ====================
+
+# Путь к файлу записи (*.jsonl.gz); пусто — запись выключена
+RECORD_TRAFFIC = os.getenv("RECORD_TRAFFIC")
+
+# Как часто сбрасывать сжатую запись на диск, с
+RECORD_FLUSH_INTERVAL = 5.0
+
+# Чат, чьё обновление сейчас обрабатывается (нужен для записи ответов AI)
+current_chat_id: contextvars.ContextVar[int | None] = contextvars.ContextVar(
+    "current_chat_id", default=None
+)
+# Бот (регион), которому пришло это обновление
+current_bot_name: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "current_bot_name", default=None
+)
+
+# Любая последовательность из 10+ цифр, в том числе с пробелами, дефисами и скобками
+PHONE_RE = re.compile(r"\+?\d(?:[\s()-]*\d){9,}")
+PERSON_KEYS = ("from", "chat", "user", "sender_chat", "forward_from")
+TEXT_KEYS = ("text", "caption", "data")
+
+
+class TrafficRecorder:
+    """Обезличенная запись входящих обновлений и исходящих вызовов бота.
+
+    Строки пишутся в gzip-файл отдельным потоком, чтобы не блокировать цикл событий.
+    Каждое событие помечено именем бота: в одном процессе их может быть несколько.
+    Идентификаторы заменяются стабильным хэшем, имена — псевдонимами, цифры
+    телефонов — псевдослучайными, сохраняя формат номера.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._salt = os.urandom(16)
+        self._ids: dict[str, str] = {}
+        self._names: dict[str, str] = {}
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._writer, name="traffic-recorder", daemon=True)
+        self._thread.start()
+        logger.info(f"🎙 Запись трафика в {path}")
+
+    def _hash(self, value: str) -> int:
+        digest = hmac.new(self._salt, value.encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:5], "big")
+
+    def fake_id(self, value: int) -> int:
+        """Стабильная замена Telegram ID (знак сохраняется для групп)"""
+        fake = 10**9 + self._hash(str(abs(value))) % (9 * 10**9)
+        self._ids[str(value)] = str(fake if value >= 0 else -fake)
+        return fake if value >= 0 else -fake
+
+    def fake_name(self, value: str) -> str:
+        """Псевдоним для каждого слова имени: в текстах они встречаются по отдельности"""
+
+        def fake_word(match: re.Match) -> str:
+            word = match.group()
+            if len(word) < 2:
+                return word
+            fake = f"user{self._hash(word) % 10**6:06d}"
+            self._names[word] = fake
+            return fake
+
+        return re.sub(r"\w+", fake_word, value)
+
+    def _fake_phone(self, match: re.Match) -> str:
+        phone = match.group()
+        digits_only = re.sub(r"\D", "", phone)
+        if digits_only in self._ids:
+            return self._ids[digits_only]
+
+        digest = hmac.new(self._salt, digits_only.encode(), hashlib.sha256).digest()
+        digits = itertools.cycle(str(int.from_bytes(digest, "big")))
+        # Префикс российского номера (+7 / 7 / 8) оставляем, чтобы номер
+        # по-прежнему распознавался, остальные цифры заменяем
+        head = 0
+        if len(digits_only) == 11 and digits_only[0] in "78":
+            head = 2 if phone.startswith("+") else 1
+        return phone[:head] + "".join(
+            next(digits) if ch.isdigit() else ch for ch in phone[head:]
+        )
+
+    def anonymise_text(self, text: str) -> str:
+        """Замена телефонов, известных ID и имён в произвольном тексте"""
+        text = PHONE_RE.sub(self._fake_phone, text)
+        text = re.sub(r"-?\d{5,}", lambda m: self._ids.get(m.group(), m.group()), text)
+        return re.sub(r"\w+", lambda m: self._names.get(m.group(), m.group()), text)
+
+    def anonymise(self, data):
+        """Рекурсивное обезличивание JSON-структуры обновления"""
+        if isinstance(data, list):
+            return [self.anonymise(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+
+        result = {}
+        for key, value in data.items():
+            if key in PERSON_KEYS and isinstance(value, dict):
+                value = dict(value)
+                if isinstance(value.get("id"), int):
+                    value["id"] = self.fake_id(value["id"])
+                for name_key in ("first_name", "last_name", "username"):
+                    if value.get(name_key):
+                        value[name_key] = self.fake_name(value[name_key])
+                result[key] = self.anonymise(value)
+            elif key == "chat_id" and isinstance(value, int):
+                result[key] = self.fake_id(value)
+            elif key in TEXT_KEYS and isinstance(value, str):
+                result[key] = self.anonymise_text(value)
+            else:
+                result[key] = self.anonymise(value)
+        return result
+
+    def write(self, kind: str, payload: dict) -> None:
+        self._queue.put({"t": time.time(), "kind": kind, **payload})
+
+    def record_meta(self, bot_name: str, admins: list[int]) -> None:
+        self.write(
+            "meta", {"bot": bot_name, "admins": [self.fake_id(admin_id) for admin_id in admins]}
+        )
+
+    def record_update(self, bot_name: str, data: dict) -> None:
+        self.write("update", {"bot": bot_name, "update": self.anonymise(data)})
+
+    def record_call(self, bot_name: str | None, endpoint: str, params: dict) -> None:
+        self.write(
+            "call", {"bot": bot_name, "endpoint": endpoint, "params": self.anonymise(params)}
+        )
+
+    def record_ai(self, bot_name: str | None, chat_id: int | None, content: str) -> None:
+        chat = self.fake_id(chat_id) if chat_id is not None else None
+        self.write(
+            "ai", {"bot": bot_name, "chat_id": chat, "content": self.anonymise_text(content)}
+        )
+
+    def record_voice(self, bot_name: str | None, chat_id: int | None, text: str) -> None:
+        """Распознанный текст голосового (при повторе подставляется вместо распознавания)"""
+        chat = self.fake_id(chat_id) if chat_id is not None else None
+        self.write("voice", {"bot": bot_name, "chat_id": chat, "text": self.anonymise_text(text)})
+
+    def _writer(self) -> None:
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            flushed_at, dirty = time.monotonic(), False
+            while True:
+                try:
+                    item = self._queue.get(timeout=RECORD_FLUSH_INTERVAL)
+                except queue.Empty:
+                    item = {}
+                if item is None:
+                    break
+                if item:
+                    f.write(json.dumps(item, ensure_ascii=False, default=str) + "\n")
+                    dirty = True
+                # Без сброса всё лежит в буфере zlib до close(): при падении
+                # процесса файл оказался бы нечитаемым целиком
+                if dirty and time.monotonic() - flushed_at >= RECORD_FLUSH_INTERVAL:
+                    f.flush()
+                    flushed_at, dirty = time.monotonic(), False
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=10)
+
+
+traffic_recorder: TrafficRecorder | None = None
+
+
+class RecordingRequest(HTTPXRequest):
+    """HTTP-клиент ботов, записывающий исходящие вызовы Bot API.
+
+    Клиент общий для всех ботов процесса, поэтому бот определяется
+    по токену в адресе запроса (…/bot<token>/<метод>).
+    """
+
+    def __init__(self, recorder: TrafficRecorder, bot_names: dict[str, str], **kwargs):
+        super().__init__(**kwargs)
+        self.recorder = recorder
+        self.bot_names = bot_names
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        token_part, endpoint = url.rsplit("/", 2)[-2:]
+        if endpoint != "getUpdates":
+            self.recorder.record_call(
+                self.bot_names.get(token_part.removeprefix("bot")),
+                endpoint,
+                request_data.parameters if request_data else {},
+            )
+        return await super().do_request(url, method, request_data, **kwargs)
+
+
+async def record_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Запись входящего обновления (группа -1, до основных обработчиков)"""
+    bot_name = context.bot_data["config"]["name"]
+    current_bot_name.set(bot_name)
+    if update.effective_chat:
+        current_chat_id.set(update.effective_chat.id)
+    if traffic_recorder:
+        traffic_recorder.record_update(bot_name, update.to_dict())
+
+
+# ==================== ГОЛОСОВЫЕ СООБЩЕНИЯ ====================
+
+# whisper — распознавание через OpenAI, stub — фиксированный текст (для тестов)
+TRANSCRIBER = os.getenv("TRANSCRIBER", "whisper")
+VOICE_WORKERS = int(os.getenv("VOICE_WORKERS", "2"))
+VOICE_QUEUE_LIMIT = int(os.getenv("VOICE_QUEUE_LIMIT", "20"))
+VOICE_MAX_BYTES = 10 * 1024 * 1024
+VOICE_CHUNK_SIZE = 64 * 1024
+
+
+class TranscriptionQueueFull(Exception):
+    """Очередь распознавания переполнена"""
+
+
+class WhisperTranscriber:
+    """Распознавание речи через OpenAI Whisper"""
+
+    def transcribe(self, audio) -> str:
+        if not openai_client:
+            raise RuntimeError("OpenAI недоступен")
+        result = openai_client.audio.transcriptions.create(
+            model="whisper-1",
+            file=("voice.ogg", audio),
+            language="ru",
+        )
+        return result.text.strip()
+
+
+class StubTranscriber:
+    """Заглушка распознавания: всегда возвращает один и тот же текст"""
+
+    def __init__(self, text: str = "Голосовое сообщение"):
+        self.text = text
+
+    def transcribe(self, audio) -> str:
+        return self.text
+
+
+class TranscriptionPool:
+    """Ограниченный пул распознавания.
+
+    Распознавание идёт в собственных потоках, чтобы не занимать общий пул
+    asyncio.to_thread, а число ожидающих задач ограничено: при всплеске
+    голосовых сообщений лишние сразу получают отказ, а не копятся в памяти.
+    """
+
+    def __init__(self, transcriber, workers: int, max_pending: int):
+        self.transcriber = transcriber
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self.failed = 0
+        self.latencies: deque[float] = deque(maxlen=1000)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcribe")
+
+    async def transcribe(self, audio) -> str:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise TranscriptionQueueFull()
+
+        self.pending += 1
+        started = time.monotonic()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, self.transcriber.transcribe, audio)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+            self.latencies.append(time.monotonic() - started)
+
+    def stats(self) -> dict:
+        latencies_ms = [value * 1000 for value in self.latencies]
+        return {
+            "queue_depth": max(0, self.pending - self.workers),
+            "in_progress": min(self.pending, self.workers),
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "p50_ms": round(percentile(latencies_ms, 50), 1),
+            "p90_ms": round(percentile(latencies_ms, 90), 1),
+            "max_ms": round(max(latencies_ms, default=0.0), 1),
+        }
+
+
+def make_transcriber():
+    """Выбор способа распознавания по TRANSCRIBER"""
+    if TRANSCRIBER == "stub":
+        return StubTranscriber(os.getenv("TRANSCRIBER_STUB_TEXT", "Голосовое сообщение"))
+    return WhisperTranscriber()
+
+
+transcription_pool = TranscriptionPool(make_transcriber(), VOICE_WORKERS, VOICE_QUEUE_LIMIT)
+
+_http_client: httpx.AsyncClient | None = None
+
+
+def http_client() -> httpx.AsyncClient:
+    """Общий HTTP-клиент для скачивания файлов"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(timeout=30)
+    return _http_client
+
+
+async def close_http_client() -> None:
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def stream_file(file_path: str):
+    """Загрузка файла с серверов Telegram по частям"""
+    async with http_client().stream("GET", file_path) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(VOICE_CHUNK_SIZE):
+            yield chunk
+
+
+async def download_voice(context: ContextTypes.DEFAULT_TYPE, voice) -> tempfile.SpooledTemporaryFile:
+    """Потоковое скачивание голосового сообщения (в память, крупные — на диск).
+
+    Загрузчик можно подменить через bot_data["voice_downloader"]
+    (например, в replay.py, чтобы не ходить в сеть).
+    """
+    if voice.file_size and voice.file_size > VOICE_MAX_BYTES:
+        raise ValueError("голосовое сообщение слишком большое")
+
+    tg_file = await context.bot.get_file(voice.file_id)
+    downloader = context.bot_data.get("voice_downloader", stream_file)
+    audio = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    try:
+        size = 0
+        async for chunk in downloader(tg_file.file_path):
+            size += len(chunk)
+            if size > VOICE_MAX_BYTES:
+                raise ValueError("голосовое сообщение слишком большое")
+            audio.write(chunk)
+    except Exception:
+        audio.close()
+        raise
+    audio.seek(0)
+    return audio
+
+
+def message_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Текст сообщения — напечатанный или распознанный из голосового"""
+    return context.user_data.pop("voice_text", None) or update.message.text
+
+
+def voice_handler(handler, state: int):
+    """Обёртка: распознаёт голосовое сообщение и передаёт текст обычному обработчику"""
+
+    async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+        voice = update.message.voice
+        logger.info(f"🎤 Голосовое сообщение: {voice.duration} с, {voice.file_size} байт")
+        context.user_data.pop("voice_cancelled", None)
+
+        text = None
+        try:
+            with await download_voice(context, voice) as audio:
+                text = await transcription_pool.transcribe(audio)
+        except TranscriptionQueueFull:
+            logger.warning(
+                f"🎤 Очередь распознавания заполнена ({transcription_pool.pending})"
+            )
+            error = (
+                "🎤 Сейчас слишком много голосовых сообщений. "
+                "Пожалуйста, напишите ответ текстом."
+            )
+        except Exception as e:
+            logger.error(f"❌ Ошибка распознавания голосового сообщения: {e}")
+            error = "❌ Не удалось распознать голосовое сообщение. Пожалуйста, напишите текстом."
+        else:
+            error = None if text else (
+                "🎤 Не удалось разобрать речь. Попробуйте ещё раз или напишите текстом."
+            )
+
+        # Пока шло распознавание, пользователь мог отправить /cancel
+        if context.user_data.pop("voice_cancelled", False):
+            return ConversationHandler.END
+        if error:
+            await update.message.reply_text(error)
+            return state
+
+        logger.info(f"🎤 Распознано: {text}")
+        if traffic_recorder:
+            traffic_recorder.record_voice(
+                context.bot_data["config"]["name"], current_chat_id.get(), text
+            )
+        await update.message.reply_text(f"🎤 Распознано: {text}")
+        context.user_data["voice_text"] = text
+        return await handler(update, context)
+
+    return handle_voice
+
+
+async def voice_in_progress(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Сообщения, пришедшие, пока распознаётся голосовое"""
+    await update.message.reply_text("🎤 Распознаю голосовое сообщение, подождите…")
+
+
+async def cancel_during_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/cancel во время распознавания: диалог завершится, как только оно закончится"""
+    context.user_data["voice_cancelled"] = True
+    await cancel(update, context)
+
+
+# ==================== МОНИТОРИНГ ====================
+
+LOOP_LAG_INTERVAL = 0.1
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.25"))
+# Порт для /health, /ready и /metrics; пусто — HTTP-сервер не запускается
+HEALTH_PORT = os.getenv("HEALTH_PORT")
+
+
+def percentile(values, q: float) -> float:
+    """Перцентиль (ближайший ранг)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class LoopWatchdog:
+    """Сторож цикла событий.
+
+    Задача в цикле событий раз в LOOP_LAG_INTERVAL отмечается и замеряет
+    опоздание своего пробуждения. Отдельный поток следит за отметками: если
+    цикл не отвечает дольше порога, он снимает стек потока цикла, то есть
+    показывает, какой синхронный код его заблокировал.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = LOOP_LAG_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        # ~10 минут истории задержек
+        self.samples: deque[float] = deque(maxlen=int(600 / interval))
+        self.stalls = 0
+        self.last_lag = 0.0
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    async def _tick(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, loop.time() - expected)
+            self.samples.append(self.last_lag)
+            self._heartbeat = time.monotonic()
+
+    def _watch(self) -> None:
+        reported_beat = None
+        while not self._stop.wait(self.interval / 2):
+            beat = self._heartbeat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled < self.threshold or beat == reported_beat:
+                continue
+
+            reported_beat = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "стек недоступен"
+            logger.warning(
+                f"🐢 Цикл событий заблокирован на {stalled * 1000:.0f} мс, стек:\n{stack}"
+            )
+
+    def start(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._tick())
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"🩺 Сторож цикла событий запущен (порог {self.threshold * 1000:.0f} мс)")
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        samples_ms = [lag * 1000 for lag in self.samples]
+        return {
+            "p50_ms": round(percentile(samples_ms, 50), 1),
+            "p90_ms": round(percentile(samples_ms, 90), 1),
+            "p99_ms": round(percentile(samples_ms, 99), 1),
+            "max_ms": round(max(samples_ms, default=0.0), 1),
+            "stalls": self.stalls,
+        }
+
+
+loop_watchdog = LoopWatchdog()
+
+
+async def collect_metrics(applications: list[Application]) -> dict:
+    """Сводка метрик для /metrics"""
+    with AI_USAGE_LOCK:
+        ai_usage = dict(AI_USAGE)
+    ai_calls = ai_usage["calls"]
+    metrics = {
+        "loop_lag": loop_watchdog.stats(),
+        "voice": transcription_pool.stats(),
+        "ai": {
+            **ai_usage,
+            "avg_latency_s": round(ai_usage["latency_total"] / ai_calls, 3) if ai_calls else 0.0,
+        },
+    }
+    metrics["outbox"] = {}
+    for application in applications:
+        name = application.bot_data["config"]["name"]
+        try:
+            metrics["outbox"][name] = await asyncio.to_thread(
+                application.bot_data["store"].outbox_stats
+            )
+        except Exception as e:
+            metrics["outbox"][name] = {"error": str(e)}
+    return metrics
+
+
+async def handle_health_request(
+    applications: list[Application], reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    """Минимальный HTTP: /health, /ready, /metrics"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        parts = request_line.decode("latin-1").split()
+        path = parts[1] if len(parts) > 1 else "/"
+
+        if path == "/health":
+            status, body = 200, {"status": "ok", "loop_lag": loop_watchdog.stats()}
+        elif path == "/ready":
+            ready = (
+                all(application.running for application in applications)
+                and loop_watchdog.last_lag < loop_watchdog.threshold
+            )
+            status, body = (200 if ready else 503), {
+                "ready": ready,
+                "loop_lag_ms": round(loop_watchdog.last_lag * 1000, 1),
+            }
+        elif path == "/metrics":
+            status, body = 200, await collect_metrics(applications)
+        else:
+            status, body = 404, {"error": "not found"}
+
+        payload = json.dumps(body, ensure_ascii=False).encode()
+        reason = {200: "OK", 404: "Not Found", 503: "Service Unavailable"}[status]
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: close\r\n\r\n".encode()
+            + payload
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.error(f"❌ Ошибка обработки запроса здоровья: {e}")
+    finally:
+        writer.close()
+
+
+_health_server: asyncio.Server | None = None
+
+
+async def start_monitoring(applications: list[Application]) -> None:
+    """Запуск сторожа цикла и HTTP-сервера метрик (один на процесс)"""
+    global _health_server
+    loop_watchdog.start()
+    if HEALTH_PORT:
+        _health_server = await asyncio.start_server(
+            lambda reader, writer: handle_health_request(applications, reader, writer),
+            port=int(HEALTH_PORT),
+        )
+        logger.info(f"🩺 /health, /ready и /metrics на порту {HEALTH_PORT}")
+
+
+async def stop_monitoring() -> None:
+    """Остановка сторожа цикла и HTTP-сервера метрик"""
+    global _health_server
+    if _health_server:
+        _health_server.close()
+        await _health_server.wait_closed()
+        _health_server = None
+    await loop_watchdog.stop()
+
+
+# ==================== НЕСКОЛЬКО БОТОВ ====================
+
+
+class SharedRequest(BaseRequest):
+    """Один пул HTTP-соединений на все боты процесса.
+
+    Каждый бот инициализирует и закрывает свой request; реальное закрытие
+    произойдёт, только когда его отпустит последний бот.
+    """
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+        self._users = 0
+
+    @property
+    def read_timeout(self) -> float | None:
+        return self.inner.read_timeout
+
+    async def initialize(self) -> None:
+        self._users += 1
+        if self._users == 1:
+            await self.inner.initialize()
+
+    async def shutdown(self) -> None:
+        self._users = max(0, self._users - 1)
+        if self._users == 0:
+            await self.inner.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        return await self.inner.do_request(url, method, request_data, **kwargs)
+
+
+def bot_config(
+    name: str,
+    token: str | None = None,
+    token_env: str | None = None,
+    admins_file: str = ADMINS_FILE,
+    prompt: str | None = None,
+    db: str | None = None,
+) -> dict:
+    """Настройки одного бота (региона).
+
+    prompt — дополнение к SYSTEM_PROMPT для региона: оно идёт после общего
+    текста, чтобы начало запроса к AI оставалось одинаковым и кэшировалось.
+    """
+    token = token or (os.getenv(token_env) if token_env else None)
+    if not token:
+        raise ValueError(f"не задан токен бота {name}")
+    return {
+        "name": name,
+        "token": token,
+        "admins_file": admins_file,
+        "system_prompt": f"{SYSTEM_PROMPT}\n\n{prompt}" if prompt else SYSTEM_PROMPT,
+        "db": db or APPLICATIONS_DB,
+    }
+
+
+def load_bot_configs() -> list[dict]:
+    """Список ботов: из BOTS_CONFIG или один бот из TELEGRAM_TOKEN"""
+    if not BOTS_CONFIG:
+        return [bot_config("default", TELEGRAM_TOKEN)] if TELEGRAM_TOKEN else []
+
+    with open(BOTS_CONFIG, "r", encoding="utf-8") as f:
+        items = json.load(f)
+
+    configs = []
+    for item in items:
+        # У каждого региона по умолчанию своя база заявок и свой список администраторов
+        item.setdefault("db", f"applications_{item['name']}.db")
+        item.setdefault("admins_file", f"admins_{item['name']}.txt")
+        configs.append(bot_config(**item))
+
+    names = [config["name"] for config in configs]
+    if len(set(names)) != len(names):
+        raise ValueError("имена ботов в BOTS_CONFIG должны быть уникальны")
+    return configs
+
+
+async def run_bots(configs: list[dict], request: BaseRequest) -> None:
+    """Запуск всех ботов в одном цикле событий до сигнала остановки"""
+    applications = [build_application(config, request=request) for config in configs]
+    if traffic_recorder:
+        for application in applications:
+            application.add_handler(TypeHandler(Update, record_update), group=-1)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    # Регионы изолированы: бот с неверным токеном или недоступный при запуске
+    # пропускается, остальные продолжают работать
+    started = []
+    try:
+        for application in applications:
+            name = application.bot_data["config"]["name"]
+            try:
+                await application.initialize()
+                started.append(application)
+                await start_outbox(application)
+                await application.start()
+                await application.updater.start_polling()
+            except Exception as e:
+                logger.error(f"❌ Бот {name} не запущен: {e}")
+                if application in started:
+                    started.remove(application)
+                    await stop_bot(application)
+                continue
+            logger.info(f"🚀 Бот {name} (@{application.bot.username}) запущен")
+
+        if not started:
+            logger.error("❌ Не удалось запустить ни одного бота")
+            return
+
+        await start_monitoring(started)
+        logger.info(
+            f"🚀 Запущено ботов: {len(started)} из {len(applications)}. Ожидаю сообщения..."
+        )
+        await stop_event.wait()
+    finally:
+        for application in reversed(started):
+            await stop_bot(application)
+        await stop_monitoring()
+        await close_http_client()
+
+
+async def stop_bot(application: Application) -> None:
+    """Остановка одного бота; ошибки логируются, чтобы не мешать остановке остальных"""
+    try:
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await stop_outbox(application)
+        await application.shutdown()
+    except Exception as e:
+        logger.error(f"❌ Ошибка остановки бота {application.bot_data['config']['name']}: {e}")
+
+
 # ==================== СЛУЖЕБНОЕ ====================
 
 
@@ -801,56 +2661,112 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 # ==================== MAIN ====================
 # ==================== MAIN ====================
 
+def build_application(config: dict, request: BaseRequest | None = None) -> Application:
+    """Сборка приложения одного бота со всеми обработчиками"""
+    # Используем ApplicationBuilder вместо Application.builder()
+    from telegram.ext import ApplicationBuilder
+
+    builder = ApplicationBuilder().token(config["token"])
+    if request is not None:
+        builder = builder.request(request)
+
+    # Создаем Application через Builder
+    application = builder.build()
+    application.bot_data["config"] = config
+    application.bot_data["store"] = ApplicationStore(config["db"])
+    application.bot_data["outbox_wakeup"] = asyncio.Event()
+
+    # Обработчик диалога
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("start", start)],
+        states={
+            CHOOSING_MODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, choose_mode)],
+            LOCATION: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_location),
+                MessageHandler(filters.VOICE, voice_handler(get_location, LOCATION), block=False),
+            ],
+            PARTICIPANTS: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_participants),
+                MessageHandler(filters.VOICE, voice_handler(get_participants, PARTICIPANTS), block=False),
+            ],
+            DAMAGE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_damage),
+                MessageHandler(filters.VOICE, voice_handler(get_damage, DAMAGE), block=False),
+            ],
+            INJURIES: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_injuries),
+                MessageHandler(filters.VOICE, voice_handler(get_injuries, INJURIES), block=False),
+            ],
+            CONTACT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_contact),
+                MessageHandler(filters.VOICE, voice_handler(get_contact, CONTACT), block=False),
+            ],
+            AI_CHAT: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, ai_chat),
+                MessageHandler(filters.VOICE, voice_handler(ai_chat, AI_CHAT), block=False),
+            ],
+            CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_application)],
+            ADMIN_MENU: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_menu_handler)],
+            ADMIN_ADD: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_handler)],
+            ADMIN_REMOVE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_remove_handler)],
+            # Пока распознаётся голосовое (обработчики с block=False)
+            ConversationHandler.WAITING: [
+                CommandHandler("cancel", cancel_during_voice),
+                MessageHandler(filters.UpdateType.MESSAGE, voice_in_progress),
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+    )
+
+    application.add_handler(conv_handler)
+    application.add_handler(CommandHandler("find", find_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("retry", retry_command))
+    application.add_handler(CallbackQueryHandler(application_callback, pattern=r"^app:"))
+    application.add_error_handler(error_handler)
+    return application
+
+
 def main() -> None:
-    """Запуск бота"""
+    """Запуск бота (или нескольких ботов из BOTS_CONFIG)"""
+    global traffic_recorder
+
+    try:
+        configs = load_bot_configs()
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения настроек ботов: {e}")
+        return
+
     # Проверка токена
-    if not TELEGRAM_TOKEN:
+    if not configs:
         logger.error("❌ TELEGRAM_TOKEN не установлен! Проверьте переменные окружения.")
         return
     
-    logger.info(f"✅ Токен бота: {'установлен' if TELEGRAM_TOKEN else 'отсутствует'}")
+    logger.info(f"✅ Ботов в конфигурации: {len(configs)} ({', '.join(c['name'] for c in configs)})")
     logger.info(f"✅ OpenAI: {'доступен' if openai_client else 'недоступен'}")
     
     try:
-        # Используем ApplicationBuilder вместо Application.builder()
-        from telegram.ext import ApplicationBuilder
-        
-        # Создаем Application через Builder
-        application = (
-            ApplicationBuilder()
-            .token(TELEGRAM_TOKEN)
-            .build()
-        )
-        
-        # Обработчик диалога
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("start", start)],
-            states={
-                CHOOSING_MODE: [MessageHandler(filters.TEXT & ~filters.COMMAND, choose_mode)],
-                LOCATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_location)],
-                PARTICIPANTS: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_participants)],
-                DAMAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_damage)],
-                INJURIES: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_injuries)],
-                CONTACT: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_contact)],
-                AI_CHAT: [MessageHandler(filters.TEXT & ~filters.COMMAND, ai_chat)],
-                CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, confirm_application)],
-                ADMIN_MENU: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_menu_handler)],
-                ADMIN_ADD: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_handler)],
-                ADMIN_REMOVE: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_remove_handler)],
-            },
-            fallbacks=[CommandHandler("cancel", cancel)],
-        )
-
-        application.add_handler(conv_handler)
-        application.add_error_handler(error_handler)
+        if RECORD_TRAFFIC:
+            traffic_recorder = TrafficRecorder(RECORD_TRAFFIC)
+            for config in configs:
+                traffic_recorder.record_meta(config["name"], load_admins(config["admins_file"]))
+            inner = RecordingRequest(
+                traffic_recorder,
+                {config["token"]: config["name"] for config in configs},
+                connection_pool_size=256,
+            )
+        else:
+            inner = HTTPXRequest(connection_pool_size=256)
 
-        # Запуск бота
-        logger.info("🚀 Бот запущен. Ожидаю сообщения...")
-        application.run_polling()
+        # Общий пул соединений к Bot API; long polling у каждого бота свой
+        asyncio.run(run_bots(configs, SharedRequest(inner)))
         
     except Exception as e:
         logger.error(f"❌ Критическая ошибка при запуске: {e}")
         raise
+    finally:
+        if traffic_recorder:
+            traffic_recorder.close()
 
 
 if __name__ == "__main__":
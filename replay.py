@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Воспроизведение записанного трафика бота (RECORD_TRAFFIC=traffic.jsonl.gz)
+
+Записанные обновления прогоняются через настоящие обработчики из bot.py
+с ускорением 1x–100x, для каждого бота (региона) из записи — отдельное
+приложение со своими администраторами и базой. Задержка считается от момента
+поступления обновления, включая ожидание в очереди. Bot API и OpenAI заменены
+заглушками, ответы AI и распознанный текст голосовых берутся из записи.
+Исходящие вызовы сравниваются с записанными, а по времени обработки
+обновлений строится распределение задержек.
+
+Пример:
+    python replay.py traffic.jsonl.gz --speed 20
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import asyncio
+import argparse
+import difflib
+import tempfile
+import re
+from collections import defaultdict, deque
+from types import SimpleNamespace
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import bot
+
+# Вызовы, не относящиеся к поведению бота
+IGNORED_ENDPOINTS = {"getMe", "getUpdates", "deleteWebhook", "setMyCommands"}
+
+# Имя бота для записей, сделанных до появления меток ботов
+DEFAULT_BOT = "default"
+
+# Номер заявки в callback_data кнопок «беру / выполнена / отклонить»
+CALLBACK_ID_RE = re.compile(r"(app:\w+:)(\d+)")
+
+STUB_BOT_USER = {
+    "id": 1000000001,
+    "is_bot": True,
+    "first_name": "Replay",
+    "username": "replay_bot",
+}
+
+
+def load_events(path: str) -> list[dict]:
+    """Чтение записи (gzip JSONL).
+
+    Запись, оборванная падением бота, читается до последней сброшенной строки.
+    """
+    events = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.endswith("\n") and line.strip():
+                    events.append(json.loads(line))
+        except EOFError:
+            print(f"⚠️ Запись оборвана, прочитано событий: {len(events)}", file=sys.stderr)
+    return events
+
+
+def normalize_text(text: str) -> str:
+    """Убираем из текста то, что законно меняется между запусками"""
+    # Телефоны в записи обезличены, в том числе примеры в текстах самого бота
+    text = bot.PHONE_RE.sub("<телефон>", text)
+    text = re.sub(r"\d{2}\.\d{2}\.\d{4} \d{2}:\d{2}(:\d{2})?", "<время>", text)
+    text = re.sub(r"№\d+", "№<n>", text)
+    text = re.sub(r"через \d+ мин", "через <n> мин", text)
+    return re.sub(r"\d+(\.\d+)? (мс|с)\b", r"<n> \2", text)
+
+
+def call_key(endpoint: str, params: dict) -> str:
+    """Представление вызова для сравнения"""
+    text = normalize_text(str(params.get("text") or params.get("caption") or ""))
+    # В callback_data номер заявки: в записи он боевой, при повторе — с 1
+    markup = CALLBACK_ID_RE.sub(r"\1<n>", str(params.get("reply_markup") or ""))
+    return f"{endpoint}: {text!r} {markup}"
+
+
+def application_ids(calls) -> list[str]:
+    """Номера заявок из callback_data исходящих вызовов, в порядке появления"""
+    ids = []
+    for _, params in calls:
+        for _, application_id in CALLBACK_ID_RE.findall(str(params.get("reply_markup") or "")):
+            if application_id not in ids:
+                ids.append(application_id)
+    return ids
+
+
+def group_calls(calls) -> dict:
+    """Исходящие вызовы по чатам, в порядке отправки"""
+    grouped = defaultdict(list)
+    for endpoint, params in calls:
+        if endpoint in IGNORED_ENDPOINTS or "chat_id" not in params:
+            continue
+        grouped[params["chat_id"]].append(call_key(endpoint, params))
+    return grouped
+
+
+class StubRequest(BaseRequest):
+    """Заглушка Bot API: запоминает вызовы и отвечает правдоподобными данными"""
+
+    def __init__(self):
+        self.calls: list[tuple[str, dict]] = []
+        self._message_id = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _message(self, params: dict) -> dict:
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": params.get("chat_id", 0), "type": "private"},
+            "from": STUB_BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        return message
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = json.loads(json.dumps(request_data.parameters, default=str)) if request_data else {}
+        self.calls.append((endpoint, params))
+
+        if endpoint == "getMe":
+            result = STUB_BOT_USER
+        elif endpoint.startswith("send") or endpoint == "editMessageText":
+            result = self._message(params)
+        elif endpoint == "getFile":
+            result = {
+                "file_id": params.get("file_id"),
+                "file_unique_id": params.get("file_id"),
+                "file_path": f"stub/{params.get('file_id')}.oga",
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class StubOpenAI:
+    """Заглушка OpenAI: отдаёт записанные ответы AI по ботам и чатам"""
+
+    def __init__(self, events: list[dict]):
+        self._answers = defaultdict(deque)
+        for event in events:
+            if event["kind"] == "ai":
+                self._answers[event_key(event)].append(event["content"])
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        answers = self._answers[current_key()]
+        content = answers.popleft() if answers else "Понял вас."
+        message = SimpleNamespace(content=content)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+
+class StubVoice:
+    """Заглушка голосовых: вместо файла с серверов Telegram — записанный текст,
+    который «распознаётся» как есть"""
+
+    def __init__(self, events: list[dict]):
+        self._texts = defaultdict(deque)
+        for event in events:
+            if event["kind"] == "voice":
+                self._texts[event_key(event)].append(event["text"])
+
+    async def download(self, file_path: str):
+        texts = self._texts[current_key()]
+        yield (texts.popleft() if texts else "").encode()
+
+    def transcribe(self, audio) -> str:
+        return audio.read().decode()
+
+
+class ReplayedBot:
+    """Один бот (регион) из записи: своё приложение, база, администраторы и заглушка Bot API"""
+
+    def __init__(self, name: str, index: int, events: list[dict], workdir: str):
+        self.name = name
+        self.request = StubRequest()
+        config = bot.bot_config(
+            name,
+            token=f"{index}:REPLAY",
+            admins_file=os.path.join(workdir, f"admins_{name}.txt"),
+            db=os.path.join(workdir, f"replay_{name}.db"),
+        )
+        self.application = bot.build_application(config, request=self.request)
+        self.recorded = [
+            (e["endpoint"], e["params"])
+            for e in events
+            if e["kind"] == "call" and event_bot(e) == name
+        ]
+        self.recorded_ids = application_ids(self.recorded)
+
+        # Обработчики с block=False выполняются отдельными задачами: их ждём,
+        # чтобы задержка учитывала распознавание голосовых, а ответы попали в сравнение
+        self.spawned: dict[int, list[asyncio.Task]] = defaultdict(list)
+        create_task = self.application.create_task
+
+        def track_task(coroutine, update=None, **kwargs):
+            task = create_task(coroutine, update=update, **kwargs)
+            if update is not None:
+                self.spawned[id(update)].append(task)
+            return task
+
+        self.application.create_task = track_task
+
+    async def remap_callback(self, data: dict) -> dict:
+        """Боевой номер заявки в нажатой кнопке → номер той же по счёту заявки при повторе"""
+        query = data.get("callback_query")
+        match = CALLBACK_ID_RE.fullmatch(query.get("data") or "") if query else None
+        if not match or match.group(2) not in self.recorded_ids:
+            return data
+        # При большом ускорении нажатие может опередить рассылку уведомления,
+        # чего в жизни не бывает: ждём, пока кнопка появится
+        index = self.recorded_ids.index(match.group(2))
+        deadline = time.monotonic() + 5
+        while len(replayed_ids := application_ids(self.request.calls)) <= index:
+            if time.monotonic() > deadline:
+                return data
+            await asyncio.sleep(0.01)
+        query = {**query, "data": match.group(1) + replayed_ids[index]}
+        return {**data, "callback_query": query}
+
+
+def event_bot(event: dict) -> str:
+    """Имя бота события (в записях одного бота метки может не быть)"""
+    return event.get("bot") or DEFAULT_BOT
+
+
+def event_key(event: dict) -> tuple:
+    return event_bot(event), event.get("chat_id")
+
+
+def current_key() -> tuple:
+    """Бот и чат обновления, которое сейчас обрабатывается"""
+    return bot.current_bot_name.get() or DEFAULT_BOT, bot.current_chat_id.get()
+
+
+def bot_names(events: list[dict]) -> list[str]:
+    """Боты из записи в порядке появления"""
+    return list(dict.fromkeys(event_bot(e) for e in events if e["kind"] in ("meta", "update")))
+
+
+async def replay(events: list[dict], speed: float, workdir: str) -> dict:
+    """Прогон записи через обработчики ботов: по приложению на каждого бота из записи"""
+    bot.openai_client = StubOpenAI(events)
+    voice = StubVoice(events)
+    bot.transcription_pool.transcriber = voice
+    bots = {
+        name: ReplayedBot(name, index, events, workdir)
+        for index, name in enumerate(bot_names(events), 1)
+    }
+    for replayed in bots.values():
+        replayed.application.bot_data["voice_downloader"] = voice.download
+
+    updates = [event for event in events if event["kind"] == "update"]
+    latencies: list[float] = []
+
+    async def process(event: dict) -> None:
+        replayed = bots[event_bot(event)]
+        application = replayed.application
+        data = await replayed.remap_callback(event["update"])
+        started = time.perf_counter()
+        async with slots[replayed.name]:
+            update = Update.de_json(data, application.bot)
+            bot.current_bot_name.set(replayed.name)
+            if update.effective_chat:
+                bot.current_chat_id.set(update.effective_chat.id)
+            await application.process_update(update)
+        await asyncio.gather(*replayed.spawned.pop(id(update), []), return_exceptions=True)
+        latencies.append(time.perf_counter() - started)
+
+    # Как и при настоящем опросе, каждый бот одновременно обрабатывает не больше
+    # concurrent_updates обновлений, остальные ждут в порядке поступления
+    slots = {
+        name: asyncio.Semaphore(replayed.application.concurrent_updates)
+        for name, replayed in bots.items()
+    }
+
+    started_bots = []
+    started = time.perf_counter()
+    try:
+        for replayed in bots.values():
+            await replayed.application.initialize()
+            started_bots.append(replayed)
+            await replayed.application.start()
+            await bot.start_outbox(replayed.application)
+
+        tasks = []
+        if updates:
+            loop = asyncio.get_running_loop()
+            t0, base = updates[0]["t"], loop.time()
+            for event in updates:
+                delay = base + (event["t"] - t0) / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(process(event)))
+            await asyncio.gather(*tasks)
+
+        # Даём очередям уведомлений разослать заявки администраторам
+        deadline = time.monotonic() + 10
+        for replayed in bots.values():
+            store = replayed.application.bot_data["store"]
+            while store.outbox_stats().get(bot.DELIVERY_PENDING) and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+    finally:
+        elapsed = time.perf_counter() - started
+        for replayed in reversed(started_bots):
+            await bot.stop_outbox(replayed.application)
+            if replayed.application.running:
+                await replayed.application.stop()
+            await replayed.application.shutdown()
+
+    def by_bot_and_chat(calls_of) -> dict:
+        return {
+            (name, chat_id): calls
+            for name, replayed in bots.items()
+            for chat_id, calls in group_calls(calls_of(replayed)).items()
+        }
+
+    return {
+        "updates": len(updates),
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "recorded": by_bot_and_chat(lambda replayed: replayed.recorded),
+        "replayed": by_bot_and_chat(lambda replayed: replayed.request.calls),
+    }
+
+
+def report(result: dict, max_diffs: int) -> int:
+    """Печать отчёта, возвращает количество расхождений"""
+    latencies_ms = [value * 1000 for value in result["latencies"]]
+    print(f"Обновлений: {result['updates']} за {result['elapsed']:.2f} с")
+    print(
+        "Задержка обработки, мс: "
+        + ", ".join(
+            f"p{q}={bot.percentile(latencies_ms, q):.1f}" for q in (50, 90, 99)
+        )
+        + f", max={max(latencies_ms, default=0):.1f}"
+    )
+
+    recorded, replayed = result["recorded"], result["replayed"]
+    diffs = 0
+    for name, chat_id in sorted(set(recorded) | set(replayed), key=str):
+        expected = recorded.get((name, chat_id), [])
+        actual = replayed.get((name, chat_id), [])
+        if expected == actual:
+            continue
+        diffs += 1
+        if diffs <= max_diffs:
+            print(f"\n--- бот {name}, чат {chat_id}")
+            sys.stdout.writelines(
+                line + "\n"
+                for line in difflib.unified_diff(
+                    expected, actual, "запись", "повтор", lineterm=""
+                )
+            )
+
+    total = len(set(recorded) | set(replayed))
+    print(f"\nЧатов: {total}, с расхождениями: {diffs}")
+    return diffs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика бота")
+    parser.add_argument("path", help="файл записи (*.jsonl.gz)")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение, 1–100")
+    parser.add_argument("--max-diffs", type=int, default=10, help="сколько расхождений показать")
+    args = parser.parse_args()
+
+    speed = min(max(args.speed, 1.0), 100.0)
+    events = load_events(os.path.abspath(args.path))
+    # При нескольких ботах в записи по строке meta на каждого, со своими администраторами
+    admins = defaultdict(list)
+    for event in events:
+        if event["kind"] == "meta":
+            admins[event_bot(event)].extend(event["admins"])
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, admin_ids in admins.items():
+            with open(os.path.join(workdir, f"admins_{name}.txt"), "w") as f:
+                f.writelines(f"{admin_id}\n" for admin_id in admin_ids)
+        result = asyncio.run(replay(events, speed, workdir))
+
+    sys.exit(1 if report(result, args.max_diffs) else 0)
+
+
+if __name__ == "__main__":
+    main()
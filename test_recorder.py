@@ -0,0 +1,54 @@
+import gzip
+import time
+
+import bot
+import replay
+
+PHONE = "9001234567"
+NAME = "Анна Мария"
+
+
+def test_recording_hides_phones_and_names(tmp_path):
+    path = tmp_path / "traffic.jsonl.gz"
+    recorder = bot.TrafficRecorder(str(path))
+    recorder.record_update(
+        "default",
+        {
+            "update_id": 1,
+            "message": {
+                "message_id": 1,
+                "date": 0,
+                "chat": {"id": 555000111, "type": "private", "first_name": NAME},
+                "from": {"id": 555000111, "is_bot": False, "first_name": NAME},
+                "text": f"Я {NAME}, телефон {PHONE}, ещё 900 123-45-67 и 7 900 123 45 67",
+            },
+        },
+    )
+    recorder.record_call(
+        "default",
+        "sendMessage",
+        {"chat_id": 1, "text": f"Имя: {NAME}\nКонтакт: {PHONE}\nTelegram ID: `555000111`"},
+    )
+    recorder.close()
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        recorded = f.read()
+
+    for secret in (PHONE, "900 123-45-67", "900 123 45 67", "555000111", "Анна", "Мария"):
+        assert secret not in recorded
+
+
+def test_truncated_recording_keeps_flushed_events(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "RECORD_FLUSH_INTERVAL", 0.01)
+    path = tmp_path / "traffic.jsonl.gz"
+    recorder = bot.TrafficRecorder(str(path))
+    for update_id in (1, 2):
+        recorder.record_update("default", {"update_id": update_id})
+    time.sleep(0.2)
+    # Процесс убит до close(): в файле только то, что успело сброситься
+    truncated = tmp_path / "killed.jsonl.gz"
+    truncated.write_bytes(path.read_bytes())
+    recorder.close()
+
+    events = replay.load_events(str(truncated))
+    assert [event["update"]["update_id"] for event in events] == [1, 2]